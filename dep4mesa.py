@@ -2,8 +2,14 @@
 #
 # Copyright (C) 2022 Luc Ma <onion0709@gmail.com>
 
-import apt
+import os
+import subprocess
 import sys
+import time
+
+# The package index is refreshed only if it is older than this (in seconds)
+APT_LISTS = "/var/lib/apt/lists"
+APT_LISTS_MAX_AGE = 3600
 
 depends = [
     "bison",
@@ -17,20 +23,36 @@ depends = [
     "zlib1g",
 ]
 
-ac = apt.cache.Cache()
-ac.update()
-ac.open()
+sudo = [] if os.geteuid() == 0 else ['sudo']
+
+# Only the dpkg status database is read here, loading the whole apt cache
+# takes seconds and the resolver of apt-get is all we need anyway
+proc = subprocess.run(['dpkg-query', '-W', '-f=${Package}\t${Status}\n',
+                       *depends], capture_output=True, text=True)
+
+installed = set()
+
+for line in proc.stdout.splitlines():
+    pkgname, status = line.split('\t')
 
-pkgs = [ac[x] for x in depends]
+    if status.endswith(" installed"):
+        installed.add(pkgname)
 
-for pkg in pkgs:
-    if pkg.is_installed:
-        print(f"{pkg.name} already installed")
+missing = []
+
+for x in depends:
+    if x in installed:
+        print(f"{x} already installed")
     else:
-        pkg.mark_install()
+        missing.append(x)
+
+if not missing:
+    sys.exit(0)
+
+if time.time() - os.stat(APT_LISTS).st_mtime > APT_LISTS_MAX_AGE:
+    subprocess.run([*sudo, 'apt-get', 'update'])
 
 try:
-    ac.commit()
+    subprocess.run([*sudo, 'apt-get', 'install', '-y', *missing], check=True)
 except Exception as e:
     print(f"{str(e)} failed to install", file=sys.stderr)
-
@@ -2,27 +2,61 @@
 # Copyright (C) 2022 Luc Ma <onion0709@gmail.com>
 
 import argparse
-import inspect
+import atexit
+import functools
+import json
 import os
+import pwd
 import re
 import shutil
-import stat
 import subprocess
 import sys
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from subprocess import (
-    Popen,
-    PIPE,
-)
 
+IS_ROOT = os.geteuid() == 0
 
-if os.geteuid() == 0:
+if IS_ROOT:
     WHOAMI = os.getenv("SUDO_USER")
 else:
     WHOAMI = os.getenv("USER")
 
 HOME = os.path.join("/home", WHOAMI)
 
+# Files and directories shared by several tools
+OH_MY_ZSH_ROOT = os.path.join(HOME, ".oh-my-zsh")
+ZSHRC = os.path.join(HOME, ".zshrc")
+VIMRC = os.path.join(HOME, ".vimrc")
+
+_DIGITS_RE = re.compile(r"\d+")
+_VERSION_RE = re.compile(r"\d+\.\d+(?:\.\d+)?")
+_ZSH_PLUGINS_RE = re.compile(r"^(plugins=\()", re.M)
+_ZSH_AUTOJUMP_RE = re.compile(r"^plugins=\([^)]*\bautojump\b", re.M)
+# Host of a git URL, either scheme://[user@]host/path or [user@]host:path
+_GIT_HOST_RE = re.compile(r"^(?:\w+://)?(?:[^@/]+@)?([^:/]+)")
+
+# Clones running at once against the same host, more than that may get
+# throttled by it. The semaphores are created on demand per host
+GIT_HOST_MAX_CLONES = 2
+_git_host_sems = {}
+_git_host_sems_lock = threading.Lock()
+
+# Versions of the installed packages, filled by DTUtils.query_installed()
+# once for all of the apt-managed tools being deployed, then kept up to
+# date in place by every apt-get install or purge
+_installed_cache = {}
+
+# Outcomes of probing the tools with `--version` as (returncode, version)
+# per command. They are kept across runs in PROBE_CACHE for as long as the
+# dpkg database is not modified
+PROBE_CACHE = os.path.join(HOME, ".cache", "devtools.json")
+DPKG_STATUS = "/var/lib/dpkg/status"
+_probe_cache = {}
+_probe_cache_mtime = None
+
 
 class bcolors:
     ENDC        = '\033[0m'
@@ -39,14 +73,17 @@ class bcolors:
     WARNING     = YELLOW
     FAIL        = RED
 
+# Escape codes are only noise when the output goes to a log file
+USE_COLOR = sys.stdout.isatty()
+
 def pr_warning(s):
-    print(f"{bcolors.WARNING}{s}{bcolors.ENDC}")
+    print(f"{bcolors.WARNING}{s}{bcolors.ENDC}" if USE_COLOR else s)
 
 def pr_failure(s):
-    print(f"{bcolors.FAIL}{s}{bcolors.ENDC}")
+    print(f"{bcolors.FAIL}{s}{bcolors.ENDC}" if USE_COLOR else s)
 
 def pr_okay(s):
-    print(f"{bcolors.OK}{bcolors.BOLD}{s}{bcolors.ENDC}")
+    print(f"{bcolors.OK}{bcolors.BOLD}{s}{bcolors.ENDC}" if USE_COLOR else s)
 
 
 class DTUtils:
@@ -54,11 +91,15 @@ class DTUtils:
     Set of utility functions
     """
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def parse_version(v):
+        # Ignore whatever is not a number, like the '-dev' of '5.9-dev'
+        return tuple(map(int, _DIGITS_RE.findall(v)))
+
     @staticmethod
     def version_lt(v1, v2):
-        vt1 = tuple(map(int, (v1.split("."))))
-        vt2 = tuple(map(int, (v2.split("."))))
-        return vt1 < vt2
+        return DTUtils.parse_version(v1) < DTUtils.parse_version(v2)
 
     @staticmethod
     def parseArgs():
@@ -72,28 +113,61 @@ class DTUtils:
         parser.add_argument('-l', '--list', dest='whatprovided',
                             action='store_true', default=False,
                             help="list all of tools you can deploy by this way")
+        parser.add_argument('-j', '--jobs', dest='jobs', metavar='N',
+                            type=int, default=None,
+                            help="download at most N tools at once "
+                                 "(default: all of them)")
+        parser.add_argument('-n', '--dry-run', dest='dry_run',
+                            action='store_true', default=False,
+                            help="only show what would be done")
 
         return parser.parse_args()
 
     @staticmethod
-    def list_all(dt_list):
+    def list_all(cmds):
         pr_okay(f"You could install the following dev tools by this way so far")
         print("\n")
-        for dt in dt_list:
-            pr_okay(f"\t{dt.dtd.cmd}")
+        for cmd in cmds:
+            pr_okay(f"\t{cmd}")
         print("\n")
 
+    @staticmethod
+    def run(cmd, **kwargs):
+        """
+        subprocess.run() for the commands this script trusts. The fds
+        Python opens are non-inheritable anyway, and not closing the rest
+        lets subprocess take its posix_spawn() fast path, provided the
+        executable is given with its path. argv[0] is left as it is
+        """
+        kwargs.setdefault('close_fds', False)
+
+        if 'executable' not in kwargs and not os.path.dirname(cmd[0]):
+            executable = shutil.which(cmd[0])
+
+            # Leave it to subprocess to raise FileNotFoundError otherwise
+            if executable is not None:
+                kwargs['executable'] = executable
+
+        return subprocess.run(cmd, **kwargs)
+
     @staticmethod
     def git_shallow_clone(dtd):
-        try:
-            if len(dtd.branch) == 0:
-                proc = Popen(['git', 'clone', '--depth', '1', dtd.url,
-                              dtd.prefix])
-            else:
-                proc = Popen(['git', 'clone', '--depth', '1', '--branch',
-                              dtd.branch, dtd.url, dtd.prefix])
+        # Only the tip of a single branch is needed, without any tags
+        cmd = ['git', 'clone', '--depth', '1', '--single-branch', '--no-tags']
 
-            (stdout, stderr) = proc.communicate()
+        if len(dtd.branch) != 0:
+            cmd += ['--branch', dtd.branch]
+
+        host = _GIT_HOST_RE.match(dtd.url).group(1)
+
+        with _git_host_sems_lock:
+            sem = _git_host_sems.setdefault(
+                host, threading.BoundedSemaphore(GIT_HOST_MAX_CLONES))
+
+        try:
+            with sem:
+                proc = DTUtils.run([*cmd, dtd.url, dtd.prefix],
+                                   stdin=subprocess.DEVNULL)
 
             if proc.returncode == 0:
                 return True
@@ -104,12 +178,120 @@ class DTUtils:
             pr_failure(f"Failed to git clone {dtd.url}")
             return False
 
+    @staticmethod
+    def query_installed(pkgnames):
+        """
+        Look up the versions of the installed packages among pkgnames
+        with a single dpkg-query invocation
+        """
+        installed = {}
+
+        try:
+            proc = DTUtils.run(['dpkg-query', '-W',
+                                '-f=${Package}\t${Status}\t${Version}\n',
+                                *pkgnames],
+                               stdin=subprocess.DEVNULL,
+                               capture_output=True, text=True)
+        except FileNotFoundError:
+            return installed
+
+        # Packages unknown to dpkg are reported on stderr only
+        for line in proc.stdout.splitlines():
+            pkgname, status, version = line.split('\t')
+
+            if status.endswith(" installed"):
+                installed[pkgname] = version
+
+        return installed
+
+    @staticmethod
+    def load_probe_cache():
+        global _probe_cache_mtime
+
+        try:
+            _probe_cache_mtime = os.stat(DPKG_STATUS).st_mtime_ns
+
+            with open(PROBE_CACHE, 'r') as f:
+                cache = json.load(f)
+
+            if cache['mtime'] == _probe_cache_mtime:
+                _probe_cache.update(cache['probes'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def save_probe_cache():
+        try:
+            # Anything probed before dpkg changed the system may be stale
+            if os.stat(DPKG_STATUS).st_mtime_ns != _probe_cache_mtime:
+                return
+
+            cache_dir = os.path.dirname(PROBE_CACHE)
+
+            if not os.path.isdir(cache_dir):
+                os.mkdir(cache_dir)
+                shutil.chown(cache_dir, WHOAMI, WHOAMI)
+
+            with open(PROBE_CACHE, 'w') as f:
+                json.dump({'mtime': _probe_cache_mtime,
+                           'probes': _probe_cache}, f)
+
+            shutil.chown(PROBE_CACHE, WHOAMI, WHOAMI)
+        except (OSError, LookupError):
+            pass
+
+    @staticmethod
+    def apt_get(args, pkgnames):
+        # No need to go through sudo if we have been root
+        cmd = [] if IS_ROOT else ['sudo']
+
+        # dpkg spends most of its time in fsync() which eatmydata turns
+        # into a no-op. Without it, --force-unsafe-io still saves dpkg the
+        # syncs while unpacking
+        if shutil.which('eatmydata'):
+            cmd.append('eatmydata')
+
+        cmd += ['apt-get',
+                '-o', 'Dpkg::Use-Pty=0',
+                '-o', 'Dpkg::Options::=--force-unsafe-io',
+                *args, *pkgnames]
+
+        try:
+            # stdin is left to dpkg for prompting about conffiles
+            return DTUtils.run(cmd).returncode == 0
+        except Exception:
+            pr_failure(f"Failed to apt-get {args[0]} {' '.join(pkgnames)}")
+            return False
+
+    @staticmethod
+    def apt_get_batch(args, pkgnames):
+        """
+        apt_get() all of pkgnames at once. apt-get gives up on all of them
+        if any one fails, e.g. it is unknown, so on failure they are tried
+        again one by one. Return the packages which failed on their own
+        """
+        if DTUtils.apt_get(args, pkgnames):
+            return []
+
+        if len(pkgnames) == 1:
+            return list(pkgnames)
+
+        pr_warning(f"Retrying apt-get {args[0]} package by package")
+
+        return [pkgname for pkgname in pkgnames
+                if not DTUtils.apt_get(args, [pkgname])]
+
 
 class DevToolDescriptor:
     """
     Describe the basic information of a dev tool
     """
 
+    # A descriptor is created for every tool requested, no need to carry
+    # a __dict__ for each of them
+    __slots__ = ('pkgname', 'cmd', 'version', 'min_version', 'curr_version',
+                 'url', 'branch', 'prefix', 'platform')
+
     def __init__(self,
                  pkgname,
                  cmd,
@@ -136,73 +318,91 @@ class DevToolDeploy:
     A set of abstract operations needed to deploy a dev tool
     """
 
+    # How the tool gets installed. devtool_deploy() batches the tools
+    # installed by apt into a single apt-get invocation, the others are
+    # downloaded concurrently and then installed one by one
+    installer = None
+
+    # Whether installing the tool may prompt on the terminal. Such a tool
+    # is not installed until all of the downloads, which may prompt for
+    # ssh or sudo credentials, are done
+    interactive = False
+
+    # Stages run one after another to install a downloaded tool
+    _STAGES = ('unpack', 'build', 'install', 'clean')
+
     def __init__(self, dtd):
         self.dtd = dtd                  # type: DevToolDescriptor
 
-    def deploy(self, uninst):
-        if uninst:
-            if self.exists():
-                self.uninstall()
-            else:
-                pr_warning(f"{self.dtd.cmd} not installed yet")
-        else:
-            if self.exists():
-                pr_okay(f"{self.dtd.cmd} {self.dtd.curr_version} has existed")
-            else:
-                if not self.download():
-                    return
-
-                self.unpack()
-                self.build()
-                self.install()
-                self.clean()
+        # Only the stages overridden in the subclass, the others are no-op
+        self._pipeline = tuple(getattr(self, stage) for stage in self._STAGES
+                               if getattr(type(self), stage)
+                               is not getattr(DevToolDeploy, stage))
 
-            # Note that configuration of a tool may not depend on
-            # its existence. It is possible that a tool has been
-            # installed but not configured at all
-            self.configure()
+    def deploy(self, uninst):
+        return devtool_deploy([self], uninst)
 
     """
     These operations can be overrided in the subclass
     """
     def exists(self):
-        curr_ver_unknown = False
-        try:
-            # It should work for most of programs on Linux
-            proc = Popen([self.dtd.cmd, '--version'], stdout=PIPE,
-                         stderr=PIPE, text=True)
-            (stdout, stderr) = proc.communicate()
+        return self.probe()
 
-            try:
-                command_not_found = re.search(r"command not found",
-                                              stderr, re.IGNORECASE)
-                if command_not_found is None:
-                    self.dtd.curr_version = re.search(r"\d+\.\d+(\.\d+)?",
-                                                      stdout).group(0)
-                else:
-                    return False
-            except AttributeError:
-                curr_ver_unknown = True
+    def probe(self):
+        """
+        Find out whether the tool exists by running it with `--version`,
+        for the tools which are not installed from a package. The outcome
+        is cached per command, see DTUtils.load_probe_cache()
+        """
+        # Do not care the version of program, so there is no need to run
+        # it, looking it up in PATH is enough
+        if len(self.dtd.min_version) == 0:
+            return shutil.which(self.dtd.cmd) is not None
 
-            # Do not care the version of program
-            if len(self.dtd.min_version) == 0:
-                return True
+        if self.dtd.cmd not in _probe_cache:
+            _probe_cache[self.dtd.cmd] = self.run_version()
 
-            if proc.returncode != 0 or curr_ver_unknown:
-                # It proves the program has existed but probably does not
-                # support the option `--version`.
-                # A minimum version is required but the current version is
-                # unresolved. In the circumstances, we are inclined to
-                # reinstall
+        (returncode, version) = _probe_cache[self.dtd.cmd]
+
+        if returncode is None:
+            return False
+
+        if version is not None:
+            self.dtd.curr_version = version
+
+        if returncode != 0 or version is None:
+            # It proves the program has existed but probably does not
+            # support the option `--version`.
+            # A minimum version is required but the current version is
+            # unresolved. In the circumstances, we are inclined to
+            # reinstall
+            return False
+        else:
+            if DTUtils.version_lt(self.dtd.curr_version,
+                                  self.dtd.min_version):
                 return False
             else:
-                if DTUtils.version_lt(self.dtd.curr_version,
-                                      self.dtd.min_version):
-                    return False
-                else:
-                    return True
-        except FileNotFoundError as e:
-            return False
+                return True
+
+    def run_version(self):
+        """
+        Run the tool with `--version` and return its exit status along with
+        the version it reports, or None for either one if unavailable
+        """
+        try:
+            # It should work for most of programs on Linux
+            proc = DTUtils.run([self.dtd.cmd, '--version'],
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, text=True)
+        except FileNotFoundError:
+            return (None, None)
+
+        # The version comes first in the output, ignore whatever banner
+        # or license text follows it
+        version = _VERSION_RE.search(proc.stdout, 0, 256)
+
+        return (proc.returncode, version.group(0) if version else None)
 
     def download(self):
         return True
@@ -214,11 +414,7 @@ class DevToolDeploy:
         pass
 
     def install(self):
-        try:
-            proc = Popen(['sudo', 'apt-get', 'install', '-y', self.dtd.pkgname])
-            (stdout, stderr) = proc.communicate()
-        except Exception:
-            pr_failure(f"Failed to apt-get install {self.dtd.pkgname}")
+        pass
 
     def configure(self):
         pass
@@ -227,101 +423,194 @@ class DevToolDeploy:
         pass
 
     def uninstall(self):
+        pass
+
+
+class AptDevToolDeploy(DevToolDeploy):
+    """
+    A dev tool installed from its deb package
+    """
+
+    installer = 'apt'
+
+    # Packages queued by install()/uninstall() until flush_apt()
+    _apt_install = []
+    _apt_purge = []
+
+    def exists(self):
+        if self.dtd.pkgname not in _installed_cache:
+            return self.probe()
+
         try:
-            proc = Popen(['sudo', 'apt-get', 'purge', self.dtd.pkgname])
-            (stdout, stderr) = proc.communicate()
-        except Exception:
-            pr_failure(f"Failed to apt-get purge {self.dtd.pkgname}")
+            self.dtd.curr_version = _VERSION_RE.search(
+                _installed_cache[self.dtd.pkgname]).group(0)
+        except AttributeError:
+            # Installed but the version is unresolved, same as probe()
+            return len(self.dtd.min_version) == 0
 
+        if len(self.dtd.min_version) == 0:
+            return True
+
+        return not DTUtils.version_lt(self.dtd.curr_version,
+                                      self.dtd.min_version)
+
+    def install(self):
+        AptDevToolDeploy._apt_install.append(self.dtd.pkgname)
 
-class DTAck(DevToolDeploy):
+    def uninstall(self):
+        AptDevToolDeploy._apt_purge.append(self.dtd.pkgname)
+
+    @classmethod
+    def flush_apt(cls):
+        """
+        Install and purge all of the queued packages, with one apt-get
+        invocation each unless installing some of them fails. Return the
+        set of the packages which failed
+        """
+        failed = set()
+
+        if cls._apt_install:
+            failed.update(DTUtils.apt_get_batch(['install', '-y'],
+                                                cls._apt_install))
+            _installed_cache.update(DTUtils.query_installed(cls._apt_install))
+
+        # Purging asks for confirmation, so it is not retried package by
+        # package. A declined or failed purge fails all of the packages
+        if cls._apt_purge:
+            if DTUtils.apt_get(['purge'], cls._apt_purge):
+                for pkgname in cls._apt_purge:
+                    _installed_cache.pop(pkgname, None)
+            else:
+                failed.update(cls._apt_purge)
+
+        cls._apt_install.clear()
+        cls._apt_purge.clear()
+
+        return failed
+
+
+class SourceDevToolDeploy(DevToolDeploy):
+    """
+    A dev tool cloned from its git repository into its prefix, which
+    exists as long as the prefix directory does. It is never run to find
+    that out
+    """
+
+    installer = 'git'
+
+    def exists(self):
+        return os.path.isdir(self.dtd.prefix)
+
+    def download(self):
+        return DTUtils.git_shallow_clone(self.dtd)
+
+
+class DTAck(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 # the silver searcher ag
-class DTAg(DevToolDeploy):
+class DTAg(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTAutojump(DevToolDeploy):
+class DTAutojump(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
     def configure(self):
-        oh_my_zsh_root = os.path.join(HOME, ".oh-my-zsh")
-        zshrc = os.path.join(HOME, ".zshrc")
-
         # Nothing to do if oh-my-zsh not installed
-        if not os.path.exists(oh_my_zsh_root):
+        if not os.path.exists(OH_MY_ZSH_ROOT):
             return
 
-        test_j = Popen(['grep', '-E', '^plugins=(.*autojump.*)', zshrc],
-                       stdout=PIPE, stderr=PIPE)
-        (stdout, stderr) = test_j.communicate()
+        try:
+            with open(ZSHRC, 'r') as f:
+                text = f.read()
 
-        if test_j.returncode == 0:
-            pr_okay(f"{self.dtd.cmd} has existed among zsh plugins")
-            return
+            if _ZSH_AUTOJUMP_RE.search(text):
+                pr_okay(f"{self.dtd.cmd} has existed among zsh plugins")
+                return
 
-        try:
-            add_zsh_plugin = Popen(['sed', '-i', 's/plugins=(/&autojump /', zshrc])
-            (stdout, stderr) = add_zsh_plugin.communicate()
+            (text, n) = _ZSH_PLUGINS_RE.subn(r"\1autojump ", text, count=1)
 
-            if add_zsh_plugin_proc.returncode == 0:
-                pr_okay(f"{zshrc} updated, please open a new terminal")
+            if n == 0:
+                pr_warning(f"No zsh plugins found in {ZSHRC}")
+                return
+
+            # Write a new file next to it and swap it in, so ~/.zshrc is
+            # never seen half written. Follow the link if ~/.zshrc is one
+            zshrc = os.path.realpath(ZSHRC)
+            st = os.stat(zshrc)
+
+            f = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(zshrc),
+                                            delete=False)
+
+            # Do not leave the new file behind, whichever step fails
+            try:
+                with f:
+                    f.write(text)
+
+                os.chmod(f.name, st.st_mode & 0o7777)
+                os.chown(f.name, st.st_uid, st.st_gid)
+                os.replace(f.name, zshrc)
+            except:
+                os.remove(f.name)
+                raise
+
+            pr_okay(f"{ZSHRC} updated, please open a new terminal")
         except:
             pr_failure(f"Failed to add {self.dtd.cmd} to zsh plugins")
 
 
-class DTCmake(DevToolDeploy):
+class DTCmake(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTCscope(DevToolDeploy):
+class DTCscope(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTCtags(DevToolDeploy):
+_CTAGS_CONF = (
+    "--recurse=yes\n"
+    "--exclude=.git\n"
+    "--exclude=build\n"
+    "--exclude=.idea\n"
+    "--exclude=\\*.swp\n"
+    "--exclude=\\*.bak\n"
+    "--exclude=\\*.pyc\n"
+)
+
+
+class DTCtags(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
         self.conf = os.path.join(HOME, ".ctags")
 
     def configure(self):
-        config = """
-            --recurse=yes
-            --exclude=.git
-            --exclude=build
-            --exclude=.idea
-            --exclude=\*.swp
-            --exclude=\*.bak
-            --exclude=\*.pyc
-        """
-
         try:
             with open(self.conf, 'w+') as f:
-                f.write(inspect.cleandoc(config))
+                f.write(_CTAGS_CONF)
 
             shutil.chown(self.conf, WHOAMI, WHOAMI)
         except:
             pass
 
 
-class DTFzf(DevToolDeploy):
+class DTFzf(SourceDevToolDeploy):
+    # The installer asks yes/no questions about the shell integrations
+    interactive = True
+
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
-    def download(self):
-        return DTUtils.git_shallow_clone(self.dtd)
-
     def install(self):
         fzf_installer = os.path.join(self.dtd.prefix, "install")
 
         try:
-            inst_proc = Popen([fzf_installer], shell=True)
-            (stdout, stderr) = inst_proc.communicate()
+            DTUtils.run([fzf_installer])
         except:
             pr_failure(f"Failed to install {self.dtd.cmd}")
 
@@ -329,65 +618,67 @@ class DTFzf(DevToolDeploy):
         fzf_uninstaller = os.path.join(self.dtd.prefix, "uninstall")
 
         try:
-            proc = Popen([fzf_uninstaller], shell=True)
-            (stdout, stderr) = proc.communicate()
+            DTUtils.run([fzf_uninstaller])
         except:
             pr_failure(f"Failed to exec {fzf_uninstaller}")
         finally:
             shutil.rmtree(self.dtd.prefix, ignore_errors=True)
 
     def configure(self):
-        vimrc = os.path.join(HOME, ".vimrc")
         appended_line = "set runtimepath+=~/.fzf"
 
         try:
-            with open(vimrc, 'r') as f:
-                for line in f:
-                    if appended_line in line:
-                        return
+            with open(VIMRC, 'r+') as f:
+                text = f.read()
 
-            with open(vimrc, 'a+') as f:
-                f.write(appended_line)
+                if appended_line in text:
+                    return
+
+                # Reading has left the position at the end of file
+                if text and not text.endswith('\n'):
+                    f.write('\n')
+
+                f.write(appended_line + '\n')
         except:
             pr_failure(f"Failed to install fzf.vim plugin")
 
 
-class DTGcc(DevToolDeploy):
+class DTGcc(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTGpp(DevToolDeploy):
+class DTGpp(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTGdb(DevToolDeploy):
+class DTGdb(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTGit(DevToolDeploy):
+class DTGit(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTMeson(DevToolDeploy):
+class DTMeson(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTPip3(DevToolDeploy):
+class DTPip3(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTTmux(DevToolDeploy):
+class DTTmux(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
 
-class DTZsh(DevToolDeploy):
+class DTZsh(AptDevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
@@ -396,20 +687,19 @@ class DTZsh(DevToolDeploy):
         Now that we have zsh installed, let's use it
         """
 
-        curr_shell = subprocess.check_output(
-            ['grep', '^' + WHOAMI, '/etc/passwd'], universal_newlines=True).strip()
+        curr_shell = pwd.getpwnam(WHOAMI).pw_shell
 
         if curr_shell.endswith("/zsh"):
             # User's login shell has been zsh
             return
 
         try:
-            first_zsh = subprocess.check_output(
-                ['grep', '-m1', '/zsh', '/etc/shells'],
-                universal_newlines=True).strip()
+            with open('/etc/shells', 'r') as f:
+                first_zsh = next(line.strip() for line in f
+                                 if line.startswith('/') and '/zsh' in line)
 
-            proc = Popen(['usermod', '--shell', first_zsh, WHOAMI])
-            (stdout, stderr) = proc.communicate()
+            proc = DTUtils.run(['usermod', '--shell', first_zsh, WHOAMI],
+                               stdin=subprocess.DEVNULL)
 
             if proc.returncode == 0:
                 pr_okay(f"{WHOAMI}'s login shell has changed to {first_zsh}\n" \
@@ -419,7 +709,7 @@ class DTZsh(DevToolDeploy):
             pr_failure(f"Failed to change login shell for {WHOAMI}")
 
 
-class DTOhMyZsh(DevToolDeploy):
+class DTOhMyZsh(SourceDevToolDeploy):
     """
     Oh My Zsh for managing your zsh configuration
     """
@@ -427,30 +717,40 @@ class DTOhMyZsh(DevToolDeploy):
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
 
-    def exists(self):
-        if os.path.exists(self.dtd.prefix):
-            return True
-        else:
-            return False
-
-    def download(self):
-        return DTUtils.git_shallow_clone(self.dtd)
-
-    def install(self):
-        pass
-
     def configure(self):
         zshrc_template = os.path.join(self.dtd.prefix,
                                       'templates', 'zshrc.zsh-template')
-        zshrc = os.path.join(HOME, '.zshrc')
         zshrc_bak = os.path.join(HOME, '.zshrc.orig')
 
-        # Optionally backup your existing ~/.zshrc file
-        if os.path.exists(zshrc):
-            shutil.copyfile(zshrc, zshrc_bak)
+        # Optionally backup your existing ~/.zshrc file. It is going to be
+        # overwritten by the template, so move it instead of copying
+        try:
+            os.replace(ZSHRC, zshrc_bak)
+            backed_up = True
+        except FileNotFoundError:
+            backed_up = False
+
+        try:
+            shutil.copyfile(zshrc_template, ZSHRC)
+        except OSError as e:
+            # Nothing replaces it, so put the original back
+            if backed_up:
+                os.replace(zshrc_bak, ZSHRC)
+
+            if not isinstance(e, FileNotFoundError):
+                raise
+
+            pr_warning(f"No such file or directory {zshrc_template}")
+            return
 
-        if os.path.exists(zshrc_template):
-            shutil.copyfile(zshrc_template, zshrc)
+        # Copied by root under sudo, so hand it over to the user. The user's
+        # primary group is not necessarily named after the user
+        if IS_ROOT:
+            try:
+                pw = pwd.getpwnam(WHOAMI)
+                os.chown(ZSHRC, pw.pw_uid, pw.pw_gid)
+            except KeyError:
+                pr_warning(f"Failed to change the owner of {ZSHRC}")
 
     def uninstall(self):
         try:
@@ -459,16 +759,24 @@ class DTOhMyZsh(DevToolDeploy):
                                             "tools", "uninstall.sh")
             os.chmod(oh_my_zsh_uninst, 0o764)
 
-            yes_p = Popen(['yes'], stdout=PIPE)
-            uninst_proc = Popen([oh_my_zsh_uninst], stdin=yes_p.stdout,
-                                shell=True, universal_newlines=True)
-            (stdout, stderr) = uninst_proc.communicate()
+            # Answer yes to whatever the uninstaller asks, the same as
+            # `yes | uninstall.sh` but without running `yes`
+            DTUtils.run([oh_my_zsh_uninst], input=b"y\n" * 32)
         except (KeyError, FileNotFoundError):
             # No oh-my-zsh to uninstall
             pass
 
 
-class DTTpm(DevToolDeploy):
+_TPM_CONF = (
+    "set -g @plugin 'tmux-plugins/tpm'\n"
+    "set -g @plugin 'tmux-plugins/tmux-sensible'\n"
+    "set -g @plugin 'tmux-plugins/tmux-resurrect'\n"
+    "\n"
+    "run '~/.tmux/plugins/tpm/tpm'\n"
+)
+
+
+class DTTpm(SourceDevToolDeploy):
     """
     Tmux Plugin Manager
     """
@@ -477,30 +785,10 @@ class DTTpm(DevToolDeploy):
         DevToolDeploy.__init__(self, dtd)
         self.conf = os.path.join(HOME, ".tmux.conf")
 
-    def exists(self):
-        if os.path.exists(self.dtd.prefix):
-            return True
-        else:
-            return False
-
-    def download(self):
-        return DTUtils.git_shallow_clone(self.dtd)
-
-    def install(self):
-        pass
-
     def configure(self):
-        config = """
-            set -g @plugin 'tmux-plugins/tpm'
-            set -g @plugin 'tmux-plugins/tmux-sensible'
-            set -g @plugin 'tmux-plugins/tmux-resurrect'
-
-            run '~/.tmux/plugins/tpm/tpm'
-        """
-
         try:
             with open(self.conf, 'a+') as f:
-                f.write(inspect.cleandoc(config))
+                f.write(_TPM_CONF)
         except:
             pr_failure(f"No such file or directory {self.conf}")
 
@@ -510,25 +798,16 @@ class DTTpm(DevToolDeploy):
         os.remove(self.conf)
 
 
-class DTVimrc(DevToolDeploy):
+class DTVimrc(SourceDevToolDeploy):
     """
     The ultimate Vim configuration
     """
 
     def __init__(self, dtd):
         DevToolDeploy.__init__(self, dtd)
-        self.rc = os.path.join(HOME, ".vimrc")
+        self.rc = VIMRC
         self.rc_bak = os.path.join(HOME, '.vimrc.orig')
 
-    def exists(self):
-        if os.path.exists(self.dtd.prefix):
-            return True
-        else:
-            return False
-
-    def download(self):
-        return DTUtils.git_shallow_clone(self.dtd)
-
     def install(self):
         vimrc_installer = os.path.join(self.dtd.prefix,
                                        "install_awesome_vimrc.sh")
@@ -538,14 +817,10 @@ class DTVimrc(DevToolDeploy):
             shutil.copyfile(self.rc, self.rc_bak)
 
         try:
-            inst_proc = Popen([vimrc_installer], shell=True)
-            (stdout, stderr) = inst_proc.communicate()
+            DTUtils.run([vimrc_installer])
         except:
             pr_failure(f"Failed to install {self.dtd.cmd}")
 
-    def configure(self):
-        pass
-
     def uninstall(self):
         shutil.rmtree(self.dtd.prefix, ignore_errors=True)
 
@@ -555,145 +830,322 @@ class DTVimrc(DevToolDeploy):
             os.remove(self.rc)
 
 
-def devtool_deploy(dt, uninst):
-    dt.deploy(uninst)
+# Tools which can be deployed by this script, keyed by the command name
+# given on the command line. Only the requested ones get instantiated
+DT_REGISTRY = {
+    "ack": (DTAck, (
+        "ack",
+        "ack",
+        ""
+    )),
+
+    "ag": (DTAg, (
+        "silversearcher-ag",
+        "ag",
+        ""
+    )),
+
+    "autojump": (DTAutojump, (
+        "autojump",
+        "autojump",
+        ""
+    )),
+
+    "cmake": (DTCmake, (
+        "cmake",
+        "cmake",
+        ""
+    )),
+
+    "cscope": (DTCscope, (
+        "cscope",
+        "cscope",
+        ""
+    )),
+
+    "ctags": (DTCtags, (
+        "universal-ctags",
+        "ctags",
+        ""
+    )),
+
+    "fzf": (DTFzf, (
+        "fzf",
+        "fzf",
+        "",
+        "",
+        "git@github.com:junegunn/fzf.git",
+        "",
+        os.path.join(HOME, ".fzf")
+    )),
+
+    "gcc": (DTGcc, (
+        "gcc",
+        "gcc",
+        ""
+    )),
+
+    "g++": (DTGpp, (
+        "g++",
+        "g++",
+        ""
+    )),
+
+    "gdb": (DTGdb, (
+        "gdb",
+        "gdb",
+        ""
+    )),
+
+    "git": (DTGit, (
+        "git",
+        "git",
+        ""
+    )),
+
+    "meson": (DTMeson, (
+        "meson",
+        "meson",
+        ""
+    )),
+
+    "ohmyzsh": (DTOhMyZsh, (
+        "ohmyzsh",
+        "ohmyzsh",
+        "",
+        "",
+        "git@github.com:ohmyzsh/ohmyzsh.git",
+        "",
+        OH_MY_ZSH_ROOT
+    )),
+
+    # it is kind of weird to add pip to the list, but anyway
+    # love python, love pip
+    "pip3": (DTPip3, (
+        "python3-pip",
+        "pip3",
+        ""
+    )),
+
+    "tmux": (DTTmux, (
+        "tmux",
+        "tmux",
+        ""
+    )),
+
+    "tpm": (DTTpm, (
+        "tpm",
+        "tpm",
+        "",
+        "",
+        "git@github.com:tmux-plugins/tpm.git",
+        "",
+        os.path.join(HOME, ".tmux", "plugins", "tpm")
+    )),
+
+    "vimrc": (DTVimrc, (
+        "vimrc",
+        "vimrc",
+        "",
+        "",
+        "git@github.com:lucmann/vimrc.git",
+        "cscope-maps",
+        os.path.join(HOME, ".vim_runtime")
+    )),
+
+    "zsh": (DTZsh, (
+        "zsh",
+        "zsh",
+        "",
+        "5.0.8"
+    )),
+}
+
+
+def devtool_deploy(dts, uninst, max_workers=None, dry_run=False):
+    """
+    Deploy a batch of dev tools. The apt-managed ones only queue their
+    packages, which are then installed or purged by a single apt-get
+    invocation, since each invocation has to reload the package cache, run
+    the triggers and sync the dpkg database. At most max_workers downloads
+    run at once, all of them if it is None.
+
+    A tool failing at any stage is reported and skipped, the others are
+    still deployed. Return False if any of them failed.
+
+    A dry run only finds out which tools exist, then tells what would be
+    done with them without doing it
+    """
+    unknown = [dt.dtd.pkgname for dt in dts if dt.installer == 'apt'
+               and dt.dtd.pkgname not in _installed_cache]
+
+    if unknown:
+        _installed_cache.update(DTUtils.query_installed(unknown))
+
+    failed = set()
+
+    def run_stage(dt, stage):
+        try:
+            stage()
+            return True
+        except Exception as e:
+            pr_failure(f"Failed to {stage.__name__} {dt.dtd.cmd}: {e}")
+            failed.add(dt)
+            return False
+
+    def report():
+        if failed:
+            pr_failure("Failed to deploy " + " ".join(
+                dt.dtd.cmd for dt in dts if dt in failed))
+
+        return not failed
+
+    if uninst and dry_run:
+        for dt in dts:
+            if dt.exists():
+                print(f"Would uninstall {dt.dtd.cmd}")
+            else:
+                pr_warning(f"{dt.dtd.cmd} not installed yet")
+
+        return True
+
+    if uninst:
+        apt_dts = []
+
+        for dt in dts:
+            if dt.exists():
+                if run_stage(dt, dt.uninstall) and dt.installer == 'apt':
+                    apt_dts.append(dt)
+
+                _probe_cache.pop(dt.dtd.cmd, None)
+            else:
+                pr_warning(f"{dt.dtd.cmd} not installed yet")
+
+        apt_failed = AptDevToolDeploy.flush_apt()
+        failed.update(dt for dt in apt_dts if dt.dtd.pkgname in apt_failed)
+
+        return report()
+
+    pending = []
+
+    for dt in dts:
+        if dt.exists():
+            # The version is unknown if the tool was only found in PATH
+            pr_okay(" ".join(filter(None, [dt.dtd.cmd, dt.dtd.curr_version,
+                                           "has existed"])))
+        else:
+            pending.append(dt)
+
+    if dry_run:
+        for dt in pending:
+            if dt.installer == 'apt':
+                print(f"Would apt-get install {dt.dtd.pkgname}")
+            elif dt.installer == 'git':
+                print(f"Would clone {dt.dtd.url} into {dt.dtd.prefix}")
+
+            if dt._pipeline and dt.installer != 'apt':
+                print(f"Would install {dt.dtd.cmd}")
+
+        for dt in dts:
+            if type(dt).configure is not DevToolDeploy.configure:
+                print(f"Would configure {dt.dtd.cmd}")
+
+        return True
+
+    fetching = [dt for dt in pending if dt.installer != 'apt']
+    deferred = []
+    apt_pkgs = [dt.dtd.pkgname for dt in pending if dt.installer == 'apt']
+
+    def download(dt):
+        try:
+            return dt.download()
+        except Exception as e:
+            pr_failure(f"Failed to download {dt.dtd.cmd}: {e}")
+            return False
+
+    def install(dt):
+        for stage in dt._pipeline:
+            if not run_stage(dt, stage):
+                break
+
+        _probe_cache.pop(dt.dtd.cmd, None)
+
+    # Downloading is network-bound, so run all of the downloads at once,
+    # including fetching the archives of the apt-managed tools. Each of
+    # them blocks a thread on the network only, hence a thread apiece
+    # unless limited by max_workers
+    if fetching or apt_pkgs:
+        workers = len(fetching) + (1 if apt_pkgs else 0)
+
+        if max_workers is not None:
+            workers = max(1, min(workers, max_workers))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            if apt_pkgs:
+                executor.submit(DTUtils.apt_get,
+                                ['install', '--download-only', '-y'],
+                                apt_pkgs)
+
+            futures = {executor.submit(download, dt): dt for dt in fetching}
+
+            # Install each tool as soon as it is downloaded, while the
+            # others are still downloading. Installing is kept to this
+            # thread, one tool at a time
+            for future in as_completed(futures):
+                dt = futures[future]
+
+                if not future.result():
+                    failed.add(dt)
+                elif dt.interactive:
+                    deferred.append(dt)
+                else:
+                    install(dt)
+
+    # Nothing else uses the terminal by now
+    for dt in deferred:
+        install(dt)
+
+    # The apt-managed tools only queue their packages here. Those are
+    # installed by one apt-get afterwards, since dpkg holds a global lock
+    for dt in pending:
+        if dt.installer == 'apt':
+            install(dt)
+
+    apt_failed = AptDevToolDeploy.flush_apt()
+    failed.update(dt for dt in pending if dt.installer == 'apt'
+                  and dt.dtd.pkgname in apt_failed)
+
+    # Note that configuration of a tool may not depend on
+    # its existence. It is possible that a tool has been
+    # installed but not configured at all
+    for dt in dts:
+        if dt not in failed:
+            run_stage(dt, dt.configure)
+
+    return report()
 
 
 if __name__ == "__main__":
     args = DTUtils.parseArgs()
 
-    dt_list = [
-        DTAck(DevToolDescriptor(
-            "ack",
-            "ack",
-            ""
-        )),
-
-        DTAg(DevToolDescriptor(
-            "silversearcher-ag",
-            "ag",
-            ""
-        )),
-
-        DTAutojump(DevToolDescriptor(
-            "autojump",
-            "autojump",
-            ""
-        )),
-
-        DTCmake(DevToolDescriptor(
-            "cmake",
-            "cmake",
-            ""
-        )),
-
-        DTCscope(DevToolDescriptor(
-            "cscope",
-            "cscope",
-            ""
-        )),
-
-        DTCtags(DevToolDescriptor(
-            "universal-ctags",
-            "ctags",
-            ""
-        )),
-
-        DTFzf(DevToolDescriptor(
-            "fzf",
-            "fzf",
-            "",
-            "",
-            "git@github.com:junegunn/fzf.git",
-            "",
-            os.path.join(HOME, ".fzf")
-        )),
-
-        DTGcc(DevToolDescriptor(
-            "gcc",
-            "gcc",
-            ""
-        )),
-
-        DTGpp(DevToolDescriptor(
-            "g++",
-            "g++",
-            ""
-        )),
-
-        DTGdb(DevToolDescriptor(
-            "gdb",
-            "gdb",
-            ""
-        )),
-
-        DTGit(DevToolDescriptor(
-            "git",
-            "git",
-            ""
-        )),
-
-        DTMeson(DevToolDescriptor(
-            "meson",
-            "meson",
-            ""
-        )),
-
-        DTOhMyZsh(DevToolDescriptor(
-            "ohmyzsh",
-            "ohmyzsh",
-            "",
-            "",
-            "git@github.com:ohmyzsh/ohmyzsh.git",
-            "",
-            os.path.join(HOME, ".oh-my-zsh")
-        )),
-
-        # it is kind of weird to add pip to the list, but anyway
-        # love python, love pip
-        DTPip3(DevToolDescriptor(
-            "python3-pip",
-            "pip3",
-            ""
-        )),
-
-        DTTmux(DevToolDescriptor(
-            "tmux",
-            "tmux",
-            ""
-        )),
-
-        DTTpm(DevToolDescriptor(
-            "tpm",
-            "tpm",
-            "",
-            "",
-            "git@github.com:tmux-plugins/tpm.git",
-            "",
-            os.path.join(HOME, ".tmux", "plugins", "tpm")
-        )),
-
-        DTVimrc(DevToolDescriptor(
-            "vimrc",
-            "vimrc",
-            "",
-            "",
-            "git@github.com:lucmann/vimrc.git",
-            "cscope-maps",
-            os.path.join(HOME, ".vim_runtime")
-        )),
-
-        DTZsh(DevToolDescriptor(
-            "zsh",
-            "zsh",
-            "",
-            "5.0.8"
-        )),
-    ]
+    DTUtils.load_probe_cache()
+
+    # A dry run leaves nothing behind, not even the cache
+    if not args.dry_run:
+        atexit.register(DTUtils.save_probe_cache)
 
     if args.whatprovided:
-        DTUtils.list_all(dt_list)
+        DTUtils.list_all(DT_REGISTRY)
+
+    dts = []
+
+    for cmd in dict.fromkeys(args.dtools):
+        if cmd not in DT_REGISTRY:
+            pr_warning(f"{cmd} is not provided, see --list")
+            continue
+
+        (cls, dtd_args) = DT_REGISTRY[cmd]
+        dts.append(cls(DevToolDescriptor(*dtd_args)))
 
-    for dt in dt_list:
-        if dt.dtd.cmd in args.dtools:
-            devtool_deploy(dt, args.uninst)
+    if not devtool_deploy(dts, args.uninst, args.jobs, args.dry_run):
+        sys.exit(1)